@@ -0,0 +1,577 @@
+"""Validate the LLM generated pandas code and rewrite it into cheaper forms before running it."""
+
+import ast
+import builtins
+from functools import lru_cache
+from keyword import iskeyword
+from types import CodeType
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.core.computation.check import NUMEXPR_INSTALLED
+
+_BUILTIN_NAMES = set(dir(builtins))
+
+# The modules the generated code may import. Only the top level modules, their submodules
+# give access to the internals.
+ALLOWED_MODULES = {"pandas", "numpy", "polars", "math", "datetime", "re"}
+# The roots the attribute chains of the generated code may start from, besides its own
+# variables and the imported modules.
+ALLOWED_ROOTS = {"df", "processed_df"}
+# The builtins the generated code may use. The others give access to the file system,
+# the interpreter or arbitrary code.
+ALLOWED_BUILTINS = {
+    "abs",
+    "all",
+    "any",
+    "bool",
+    "dict",
+    "divmod",
+    "enumerate",
+    "Exception",
+    "filter",
+    "float",
+    "frozenset",
+    "IndexError",
+    "int",
+    "isinstance",
+    "KeyError",
+    "len",
+    "list",
+    "map",
+    "max",
+    "min",
+    "print",
+    "range",
+    "reversed",
+    "round",
+    "set",
+    "slice",
+    "sorted",
+    "str",
+    "sum",
+    "tuple",
+    "TypeError",
+    "ValueError",
+    "zip",
+    "ZeroDivisionError",
+}
+# The to_* conversions that stay in memory, the others write files.
+ALLOWED_TO_ATTRS = {
+    "to_arrow",
+    "to_datetime",
+    "to_dict",
+    "to_dicts",
+    "to_flat_index",
+    "to_frame",
+    "to_list",
+    "to_numeric",
+    "to_numpy",
+    "to_pandas",
+    "to_period",
+    "to_pydatetime",
+    "to_records",
+    "to_series",
+    "to_timedelta",
+    "to_timestamp",
+}
+# The attributes that lead into the module internals, read or write files, or run
+# foreign code.
+FORBIDDEN_ATTRS = {
+    "api",
+    "common",
+    "compat",
+    "core",
+    "ctypeslib",
+    "DataSource",
+    "deserialize",
+    "distutils",
+    "dump",
+    "dumps",
+    "ExcelFile",
+    "ExcelWriter",
+    "f2py",
+    "fromfile",
+    "fromregex",
+    "genfromtxt",
+    "HDFStore",
+    "io",
+    "lib",
+    "load",
+    "loads",
+    "loadtxt",
+    "memmap",
+    "os",
+    "plot",
+    "plotting",
+    "plugins",
+    "register_plugin_function",
+    "save",
+    "savefig",
+    "savetxt",
+    "savez",
+    "savez_compressed",
+    "sql",
+    "SQLContext",
+    "subprocess",
+    "sys",
+    "testing",
+    "tofile",
+    "util",
+    "utils",
+}
+# The prefixes of the attributes that read or write files.
+FORBIDDEN_ATTR_PREFIXES = ("_", "read_", "scan_", "sink_", "write_")
+
+
+def bound_names(tree: ast.AST) -> Set[str]:
+    """Get the names the code binds itself: variables, arguments, functions and imports."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.split(".")[0])
+    return names
+
+
+class CodeValidator(ast.NodeVisitor):
+    """CodeValidator checks the generated code against an allowlist: it only imports the data
+    libraries, only uses df, processed_df, its own variables, the imported modules and the
+    safe builtins, never reaches into the module internals or the file system, and assigns
+    processed_df.
+    """
+
+    def __init__(self, local_names: Set[str] = frozenset()):
+        self.violations: List[str] = []
+        self.assigns_processed_df = False
+        self._known_names = ALLOWED_ROOTS | ALLOWED_BUILTINS | set(local_names)
+
+    def visit_Import(self, node: ast.Import) -> None:
+        for alias in node.names:
+            self._check_module(alias.name)
+        self.generic_visit(node)
+
+    def visit_ImportFrom(self, node: ast.ImportFrom) -> None:
+        if node.level:
+            self.violations.append("Forbidden relative import.")
+        self._check_module(node.module or "")
+        for alias in node.names:
+            if alias.name == "*":
+                self.violations.append(f"Forbidden import '*' from '{node.module}'.")
+            else:
+                self._check_attr(alias.name)
+        self.generic_visit(node)
+
+    def visit_Name(self, node: ast.Name) -> None:
+        if node.id.startswith("__") or (
+            node.id in _BUILTIN_NAMES and node.id not in ALLOWED_BUILTINS
+        ):
+            # Checked in any context, or binding the name first would let it through.
+            self.violations.append(f"Forbidden name '{node.id}'.")
+        elif isinstance(node.ctx, ast.Load) and node.id not in self._known_names:
+            self.violations.append(f"Unknown name '{node.id}'.")
+        if node.id == "processed_df" and isinstance(node.ctx, ast.Store):
+            self.assigns_processed_df = True
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        self._check_attr(node.attr)
+        self.generic_visit(node)
+
+    def _check_attr(self, attr: str) -> None:
+        if (
+            attr.startswith(FORBIDDEN_ATTR_PREFIXES)
+            or attr in FORBIDDEN_ATTRS
+            or (attr.startswith("to_") and attr not in ALLOWED_TO_ATTRS)
+        ):
+            self.violations.append(f"Forbidden attribute '{attr}'.")
+
+    def _check_module(self, module: str) -> None:
+        if module not in ALLOWED_MODULES:
+            self.violations.append(f"Forbidden import '{module}'.")
+
+
+@lru_cache(maxsize=128)
+def validate_code(code: str) -> Tuple[str, ...]:
+    """Validate the generated code, cached by the code string.
+
+    Returns:
+        Tuple[str, ...]: The violations found, empty if the code is valid.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return (f"Syntax error: {e}",)
+    validator = CodeValidator(bound_names(tree))
+    validator.visit(tree)
+    if not validator.assigns_processed_df:
+        validator.violations.append("The code does not assign processed_df.")
+    return tuple(validator.violations)
+
+
+class TopKRewriter(ast.NodeTransformer):
+    """TopKRewriter turns df.sort_values(by, ascending=...).head(k) into df.nlargest(k, by)
+    or df.nsmallest(k, by), which selects with a heap of size k instead of sorting all rows.
+    """
+
+    def __init__(self):
+        self.rewritten = 0
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        self.generic_visit(node)
+        k = self._head_k(node)
+        if k is None:
+            return node
+        sort_call = node.func.value
+        if not (
+            isinstance(sort_call, ast.Call)
+            and isinstance(sort_call.func, ast.Attribute)
+            and sort_call.func.attr == "sort_values"
+        ):
+            return node
+        by, ascending = self._sort_args(sort_call)
+        if by is None or ascending is None:
+            return node
+        self.rewritten += 1
+        return ast.copy_location(
+            ast.Call(
+                func=ast.Attribute(
+                    value=sort_call.func.value,
+                    attr="nsmallest" if ascending else "nlargest",
+                    ctx=ast.Load(),
+                ),
+                args=[ast.Constant(value=k), by],
+                keywords=[],
+            ),
+            node,
+        )
+
+    @staticmethod
+    def _head_k(node: ast.Call) -> Optional[int]:
+        """Get k of a .head(k) call with a constant k, None if the call is not like that."""
+        if not (isinstance(node.func, ast.Attribute) and node.func.attr == "head"):
+            return None
+        if len(node.args) == 1 and not node.keywords:
+            arg = node.args[0]
+        elif not node.args and len(node.keywords) == 1 and node.keywords[0].arg == "n":
+            arg = node.keywords[0].value
+        else:
+            return None
+        if (
+            isinstance(arg, ast.Constant)
+            and isinstance(arg.value, int)
+            and not isinstance(arg.value, bool)
+            and arg.value > 0
+        ):
+            return arg.value
+        return None
+
+    @staticmethod
+    def _sort_args(node: ast.Call):
+        """Get (by, ascending) of a sort_values call, (None, None) if it cannot be rewritten.
+        Only the by and ascending arguments are supported, anything else changes the semantics.
+        """
+        by = node.args[0] if len(node.args) == 1 else None
+        ascending = True
+        if len(node.args) > 1:
+            return None, None
+        for keyword in node.keywords:
+            if keyword.arg == "by" and by is None:
+                by = keyword.value
+            elif (
+                keyword.arg == "ascending"
+                and isinstance(keyword.value, ast.Constant)
+                and isinstance(keyword.value.value, bool)
+            ):
+                ascending = keyword.value.value
+            else:
+                return None, None
+        return by, ascending
+
+
+def _literal_columns(node: ast.AST) -> Optional[List[str]]:
+    """Get the column names of a 'col' or ['col1', 'col2'] literal, None if it is not one."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if isinstance(node, ast.List) and all(
+        isinstance(elt, ast.Constant) and isinstance(elt.value, str)
+        for elt in node.elts
+    ):
+        return [elt.value for elt in node.elts]
+    return None
+
+
+def used_columns(tree: ast.Module, columns: Tuple[str, ...]) -> Optional[List[str]]:
+    """Get the columns the code reads from df, None if the code may need all the columns.
+
+    Every use of df must be one of df['col'], df[['col1', 'col2']], df.col,
+    df[rows][['col1', 'col2']] or df.loc[rows, ['col1', 'col2']], where rows is
+    any expression. Anything else, e.g. calling a method of df, needs all the columns.
+    df.col is only taken as a column if col is not also a DataFrame attribute such as count.
+    None is also returned if no rows are selected, the projection would only add a copy then.
+    """
+    parents: Dict[ast.AST, ast.AST] = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+    used = set()
+    rows_selected = False
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Name) and node.id == "df"):
+            continue
+        if not isinstance(node.ctx, ast.Load):
+            return None
+        parent = parents.get(node)
+        grandparent = parents.get(parent)
+        selected = None
+        if isinstance(parent, ast.Subscript) and parent.value is node:
+            selected = _literal_columns(parent.slice)
+            if (
+                selected is None
+                and isinstance(grandparent, ast.Subscript)
+                and grandparent.value is parent
+            ):
+                selected = _literal_columns(grandparent.slice)
+                rows_selected = True
+        elif isinstance(parent, ast.Attribute) and parent.value is node:
+            if (
+                parent.attr in columns
+                and not hasattr(pd.DataFrame, parent.attr)
+                and not (
+                    isinstance(grandparent, ast.Call) and grandparent.func is parent
+                )
+            ):
+                selected = [parent.attr]
+            elif (
+                parent.attr == "loc"
+                and isinstance(grandparent, ast.Subscript)
+                and isinstance(grandparent.slice, ast.Tuple)
+                and len(grandparent.slice.elts) == 2
+            ):
+                selected = _literal_columns(grandparent.slice.elts[1])
+                rows_selected = True
+        if selected is None:
+            return None
+        used.update(selected)
+    if not used or not used.issubset(columns) or not rows_selected:
+        return None
+    return [column for column in columns if column in used]
+
+
+def project_columns(tree: ast.Module, columns: Tuple[str, ...]) -> bool:
+    """Insert df = df[[...]] at the top of the code so only the used columns are touched.
+
+    Returns:
+        bool: Whether the projection is inserted.
+    """
+    used = used_columns(tree, columns)
+    if used is None or len(used) == len(columns):
+        return False
+    projection = ast.Assign(
+        targets=[ast.Name(id="df", ctx=ast.Store())],
+        value=ast.Subscript(
+            value=ast.Name(id="df", ctx=ast.Load()),
+            slice=ast.List(
+                elts=[ast.Constant(value=column) for column in used], ctx=ast.Load()
+            ),
+            ctx=ast.Load(),
+        ),
+    )
+    tree.body.insert(0, projection)
+    return True
+
+
+class EvalRewriter(ast.NodeTransformer):
+    """EvalRewriter turns arithmetic and comparison expressions over df columns,
+    e.g. (df['a'] + df['b'] * df['c']) > 0, into df.eval("((a + (b * c)) > 0)", engine="numexpr").
+    NumExpr evaluates them in a single pass without a temporary Series per operator.
+    Only expressions with at least min_ops operators and one column are rewritten, and only
+    when numexpr is installed and all their columns have numpy numeric dtypes: otherwise
+    pandas switches to its python engine, which is slower than the plain expression.
+    ** and % are left out, numexpr does not match numpy on negative integers for them.
+    """
+
+    OPERATORS = {
+        ast.Add: "+",
+        ast.Sub: "-",
+        ast.Mult: "*",
+        ast.Div: "/",
+        ast.BitAnd: "&",
+        ast.BitOr: "|",
+        ast.Gt: ">",
+        ast.GtE: ">=",
+        ast.Lt: "<",
+        ast.LtE: "<=",
+        ast.Eq: "==",
+        ast.NotEq: "!=",
+        ast.USub: "-",
+        ast.Invert: "~",
+    }
+
+    def __init__(self, columns: Tuple[str, ...], min_ops: int = 2):
+        # The columns numexpr can evaluate.
+        self.columns = columns
+        self.min_ops = min_ops
+        self.rewritten = 0
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        return self._rewrite(node)
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        return self._rewrite(node)
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        return self._rewrite(node)
+
+    def _rewrite(self, node: ast.expr) -> ast.AST:
+        """Replace the largest eligible expression, otherwise look into the children."""
+        converted = self._to_expr(node)
+        if converted is None or converted[1] < self.min_ops or not converted[2]:
+            return self.generic_visit(node)
+        self.rewritten += 1
+        return ast.copy_location(
+            ast.Call(
+                func=ast.Attribute(
+                    value=ast.Name(id="df", ctx=ast.Load()), attr="eval", ctx=ast.Load()
+                ),
+                args=[ast.Constant(value=converted[0])],
+                keywords=[
+                    ast.keyword(arg="engine", value=ast.Constant(value="numexpr"))
+                ],
+            ),
+            node,
+        )
+
+    def _to_expr(self, node: ast.expr) -> Optional[Tuple[str, int, int]]:
+        """Convert the node to a df.eval expression, with its numbers of operators and columns.
+        None if the node is not made of df columns, numbers and the supported operators.
+        """
+        if isinstance(node, ast.BinOp) and type(node.op) in self.OPERATORS:
+            left = self._to_expr(node.left)
+            right = self._to_expr(node.right)
+            if left is None or right is None:
+                return None
+            op = self.OPERATORS[type(node.op)]
+            return (
+                f"({left[0]} {op} {right[0]})",
+                left[1] + right[1] + 1,
+                left[2] + right[2],
+            )
+        if (
+            isinstance(node, ast.Compare)
+            and len(node.ops) == 1
+            and type(node.ops[0]) in self.OPERATORS
+        ):
+            left = self._to_expr(node.left)
+            right = self._to_expr(node.comparators[0])
+            if left is None or right is None:
+                return None
+            op = self.OPERATORS[type(node.ops[0])]
+            return (
+                f"({left[0]} {op} {right[0]})",
+                left[1] + right[1] + 1,
+                left[2] + right[2],
+            )
+        if isinstance(node, ast.UnaryOp) and type(node.op) in self.OPERATORS:
+            operand = self._to_expr(node.operand)
+            if operand is None:
+                return None
+            op = self.OPERATORS[type(node.op)]
+            return f"({op}{operand[0]})", operand[1] + 1, operand[2]
+        if (
+            isinstance(node, ast.Constant)
+            and isinstance(node.value, (int, float))
+            and not isinstance(node.value, bool)
+        ):
+            return repr(node.value), 0, 0
+        column = self._column(node)
+        if column is None:
+            return None
+        if column.isidentifier() and not iskeyword(column):
+            return column, 0, 1
+        return f"`{column}`", 0, 1
+
+    def _column(self, node: ast.expr) -> Optional[str]:
+        """Get the column name of df['col'] or df.col, None if the node is not one."""
+        if isinstance(node, ast.Subscript):
+            if not (isinstance(node.value, ast.Name) and node.value.id == "df"):
+                return None
+            columns = _literal_columns(node.slice)
+            if columns is None or not isinstance(node.slice, ast.Constant):
+                return None
+            column = columns[0]
+        elif isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.value.id == "df"):
+                return None
+            column = node.attr
+        else:
+            return None
+        if column not in self.columns or "`" in column:
+            return None
+        return column
+
+
+def numexpr_columns(
+    columns: Tuple[str, ...], dtypes: Tuple[str, ...]
+) -> Tuple[str, ...]:
+    """Get the columns with numpy bool, integer or float dtypes, the ones numexpr supports.
+    Extension dtypes, e.g. the pyarrow backed ones, are not numpy dtypes and are left out.
+    """
+    numeric = []
+    for column, dtype in zip(columns, dtypes):
+        try:
+            if np.dtype(dtype).kind in "biuf":
+                numeric.append(column)
+        except TypeError:
+            continue
+    return tuple(numeric)
+
+
+def optimize_code(
+    code: str, columns: Tuple[str, ...] = (), dtypes: Tuple[str, ...] = ()
+) -> Optional[ast.Module]:
+    """Parse and rewrite the code, return None if nothing was rewritten.
+    The column based rewrites are only applied when the columns of df are given, and
+    the df.eval rewrite only when their dtypes are given as well.
+    """
+    tree = ast.parse(code)
+    rewriter = TopKRewriter()
+    tree = rewriter.visit(tree)
+    if not columns:
+        return ast.fix_missing_locations(tree) if rewriter.rewritten else None
+    projected = project_columns(tree, columns)
+    eval_rewritten = 0
+    eval_columns = numexpr_columns(columns, dtypes)
+    if NUMEXPR_INSTALLED and eval_columns:
+        eval_rewriter = EvalRewriter(eval_columns)
+        tree = eval_rewriter.visit(tree)
+        eval_rewritten = eval_rewriter.rewritten
+    if not rewriter.rewritten and not projected and not eval_rewritten:
+        return None
+    return ast.fix_missing_locations(tree)
+
+
+@lru_cache(maxsize=128)
+def compile_code(
+    code: str, columns: Tuple[str, ...] = (), dtypes: Tuple[str, ...] = ()
+) -> Tuple[CodeType, Optional[CodeType]]:
+    """Compile the code and its optimized version, cached by the code string and the schema.
+
+    Returns:
+        Tuple[CodeType, Optional[CodeType]]: The original and the optimized code objects.
+            The optimized one is None if nothing was rewritten.
+    """
+    code_obj = compile(code, "<gen>", "exec")
+    optimized_tree = optimize_code(code, columns, dtypes)
+    if optimized_tree is None:
+        return code_obj, None
+    return code_obj, compile(optimized_tree, "<gen>", "exec")
@@ -1,15 +1,183 @@
 import asyncio
+import hashlib
 import os
 import re
+import sqlite3
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from io import StringIO
-from typing import List
+from typing import Any, List, Literal, Optional, Tuple
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from code_rewriter import compile_code, validate_code
+from file_reader import read_file_with_io_uring
 from polymind.core.logger import Logger
 from polymind.core.message import Message
 from polymind.core.tool import BaseTool, Param
 from polymind.core_tools.llm_tool import OpenAIChatTool
 
+# The first ```python``` blob in the LLM response. Non-greedy, so a response with several
+# blobs does not capture the text in between.
+CODE_BLOCK_PATTERN = re.compile(r"```python\n(.*?)\n```", re.DOTALL)
+
+DEFAULT_CODE_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "data_talker", "codecache.sqlite"
+)
+
+
+def df_to_arrow(df: pd.DataFrame) -> bytes:
+    """Serialize the DataFrame into the Arrow IPC stream format.
+    A RangeIndex is stored as metadata only, any other index is kept as columns.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=None)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def arrow_to_df(df_arrow: bytes) -> pd.DataFrame:
+    """Deserialize the DataFrame from the Arrow IPC stream format."""
+    table = pa.ipc.open_stream(pa.py_buffer(df_arrow)).read_all()
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def read_csv(csv_path: str) -> pd.DataFrame:
+    """Read the csv with the multithreaded pyarrow reader into an Arrow backed DataFrame.
+    The file is loaded with io_uring when available, otherwise pyarrow reads it itself.
+    """
+    content = read_file_with_io_uring(csv_path)
+    table = pacsv.read_csv(
+        csv_path if content is None else pa.BufferReader(content),
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=8 << 20),
+    )
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _copy_for_exec(df: pd.DataFrame) -> pd.DataFrame:
+    """Copy the df for the generated code, so in-place changes do not leak into the caller.
+    The shallow copy is enough under copy on write, which is always on since pandas 3.
+    """
+    if int(pd.__version__.split(".")[0]) >= 3 or pd.options.mode.copy_on_write is True:
+        return df.copy(deep=False)
+    return df.copy()
+
+
+@lru_cache(maxsize=32)
+def _schema_for(columns: Tuple[str, ...], dtypes: Tuple[str, ...]) -> str:
+    """Build the schema string of a DataFrame from its column names and dtypes."""
+    return str(dict(zip(columns, dtypes)))
+
+
+def df_schema_of(df: pd.DataFrame) -> str:
+    """Get the schema string of the DataFrame, reused across calls on the same columns."""
+    return _schema_for(tuple(df.columns), tuple(map(str, df.dtypes)))
+
+
+def _collect(lazy_df: Any, streaming: bool) -> Any:
+    """Collect the polars LazyFrame, with the streaming engine if asked.
+    Polars 1.23 replaced collect(streaming=True) with collect(engine="streaming").
+    """
+    import polars as pl
+
+    if not streaming:
+        return lazy_df.collect()
+    version = tuple(int(part) for part in re.findall(r"\d+", pl.__version__)[:2])
+    if version >= (1, 23):
+        return lazy_df.collect(engine="streaming")
+    return lazy_df.collect(streaming=True)
+
+
+class CodeCache:
+    """CodeCache stores the generated code keyed by the user requirement and the df schema.
+
+    The most recently used entries are kept in memory and all the entries are persisted in
+    a sqlite file, so the same requirement on the same schema would not trigger the LLM
+    again, even after a restart. The sqlite I/O runs in a worker thread to keep the event
+    loop responsive.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_CODE_CACHE_PATH, max_entries: int = 1024):
+        self._db_path = db_path
+        self._max_entries = max_entries
+        self._memory: "OrderedDict[bytes, str]" = OrderedDict()
+        self._logger = Logger(__file__)
+        self._persistent = self._init_db()
+
+    @staticmethod
+    def make_key(
+        user_requirement: str, df_schema: str, engine: str = "pandas"
+    ) -> bytes:
+        """Hash the normalized user requirement together with the df schema and the engine."""
+        raw = user_requirement.strip().lower() + "\0" + df_schema + "\0" + engine
+        return hashlib.blake2b(raw.encode("utf-8")).digest()
+
+    def _init_db(self) -> bool:
+        """Create the sqlite table if needed. Fall back to memory only on failure."""
+        try:
+            os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+            with sqlite3.connect(self._db_path) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS code_cache "
+                    "(hash BLOB PRIMARY KEY, code TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+            return True
+        except (OSError, sqlite3.Error) as e:
+            self._logger.warning(f"Code cache is not persisted: {e}")
+            return False
+
+    def _remember(self, key: bytes, code: str) -> None:
+        """Put the entry in memory as the most recently used, evicting the least recent."""
+        self._memory[key] = code
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_entries:
+            self._memory.popitem(last=False)
+
+    def _read_db(self, key: bytes) -> Optional[str]:
+        """Read the code from the sqlite file. Blocking, run in a worker thread."""
+        try:
+            with sqlite3.connect(self._db_path) as conn:
+                row = conn.execute(
+                    "SELECT code FROM code_cache WHERE hash = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            self._logger.warning(f"Failed to read the code cache: {e}")
+            return None
+        return None if row is None else row[0]
+
+    def _write_db(self, key: bytes, code: str) -> None:
+        """Write the code to the sqlite file. Blocking, run in a worker thread."""
+        try:
+            with sqlite3.connect(self._db_path) as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO code_cache (hash, code, created_at) VALUES (?, ?, ?)",
+                    (key, code, time.time()),
+                )
+        except sqlite3.Error as e:
+            self._logger.warning(f"Failed to write the code cache: {e}")
+
+    async def get(self, key: bytes) -> Optional[str]:
+        """Get the cached code, looking into the sqlite file if not in memory."""
+        code = self._memory.get(key)
+        if code is not None:
+            self._memory.move_to_end(key)
+            return code
+        if not self._persistent:
+            return None
+        code = await asyncio.to_thread(self._read_db, key)
+        if code is not None:
+            self._remember(key, code)
+        return code
+
+    async def set(self, key: bytes, code: str) -> None:
+        """Store the code in memory and in the sqlite file."""
+        self._remember(key, code)
+        if self._persistent:
+            await asyncio.to_thread(self._write_db, key, code)
+
 
 class DataFrameProcessTool(BaseTool):
     """DataFrameProcessTool is a tool to post-process the DataFrame based on user requirement."""
@@ -44,6 +212,42 @@ class DataFrameProcessTool(BaseTool):
     ---
     """
 
+    polars_prompt_template: str = """
+    You would need to generate python code to post process the given df based on the user requirement.
+    The df is a polars DataFrame, please use the polars lazy API so the query can be optimized as a whole.
+    Please note the column description may not be 100% accurate, use your best judgement.
+    If the column value looks like numbers, treat them as numbers.
+    Please put the generated code into the ```python``` blob.
+
+    You would always assume the the function sketch is:
+    ```python
+    import polars as pl
+    # Build the query from df.lazy() and store the LazyFrame as "processed_df", do not collect it
+
+    ```
+
+    For example:
+    ```python
+    import polars as pl
+    processed_df = df.lazy().sort(by='name', descending=False)
+    ```
+
+    Now the requirement of the user is as below:
+    ---
+    {user_requirement}
+    ---
+
+    And the schema of this df is as below:
+    ---
+    {df_schema}
+    ---
+    """
+
+    # The engine the generated code runs on. "polars" requires polars to be installed.
+    engine: Literal["pandas", "polars"] = "pandas"
+    # The LazyFrame is collected in streaming mode when the df has at least this many rows.
+    streaming_min_rows: int = 1_000_000
+
     def __init__(self, tool_name: str = "df-process-tool", *args, **kwargs):
         descriptions: List[str] = [
             "Post-process the DataFrame based on user requirement.",
@@ -54,7 +258,17 @@ class DataFrameProcessTool(BaseTool):
             tool_name=tool_name, descriptions=descriptions, *args, **kwargs
         )
         self._llm_tool = OpenAIChatTool(tool_name="code-generator")
+        self._code_cache = CodeCache()
         self._logger = Logger(__file__)
+        # Split the prompt template around the placeholders once, so building a prompt
+        # is a plain concatenation with a stable prefix.
+        prompt_template = (
+            self.polars_prompt_template
+            if self.engine == "polars"
+            else self.prompt_template
+        )
+        self._prompt_head, rest = prompt_template.split("{user_requirement}", 1)
+        self._prompt_mid, self._prompt_tail = rest.split("{df_schema}", 1)
 
     def input_spec(self) -> List[Param]:
         return [
@@ -65,13 +279,36 @@ class DataFrameProcessTool(BaseTool):
                 description="The user requirement to post-process the DataFrame.",
                 example="Sort the data by column 'name' in ascending order.",
             ),
+            Param(
+                name="df",
+                type="pandas.DataFrame",
+                required=False,
+                description="The DataFrame itself, used when the caller is in the same process.",
+                example="pd.DataFrame({'name': ['Alice', 'Bob'], 'age': [25, 30]})",
+            ),
+            Param(
+                name="df_arrow",
+                type="Any",
+                required=False,
+                description="The DataFrame serialized as Arrow IPC stream bytes. Used when df is not given.",
+                example="df_to_arrow(df)",
+            ),
             Param(
                 name="df_json",
                 type="str",
-                required=True,
-                description="The content of the DataFrame.",
+                required=False,
+                description="The content of the DataFrame in json. Used when neither df nor df_arrow is given.",
                 example="{'name': ['Alice', 'Bob'], 'age': [25, 30]}",
             ),
+            Param(
+                name="output_format",
+                type="str",
+                required=False,
+                description="""The format of the post-processed df, one of "df", "arrow", "json" or "records".
+                Defaults to the format of the input DataFrame. "records" returns the rows as dicts
+                and the column names, ready for a grid table.""",
+                example="records",
+            ),
         ]
 
     def output_spec(self) -> List[Param]:
@@ -79,35 +316,105 @@ class DataFrameProcessTool(BaseTool):
             Param(
                 name="output",
                 type="str",
-                required=True,
-                description="The post-processed df in json.",
+                required=False,
+                description="The post-processed df in json. Returned when the input is df_json.",
                 example="{'name': ['Alice', 'Bob'], 'age': [25, 30]}",
             ),
+            Param(
+                name="output_arrow",
+                type="Any",
+                required=False,
+                description="The post-processed df as Arrow IPC stream bytes. Returned when the input is df_arrow.",
+                example="df_to_arrow(processed_df)",
+            ),
+            Param(
+                name="df",
+                type="pandas.DataFrame",
+                required=False,
+                description="The post-processed df. Returned when the input is df.",
+                example="pd.DataFrame({'name': ['Alice', 'Bob'], 'age': [25, 30]})",
+            ),
+            Param(
+                name="records",
+                type="List[Dict[str, Any]]",
+                required=False,
+                description="The rows of the post-processed df. Returned when output_format is records.",
+                example="[{'name': 'Alice', 'age': 25}, {'name': 'Bob', 'age': 30}]",
+            ),
+            Param(
+                name="columns",
+                type="List[str]",
+                required=False,
+                description="The column names of the post-processed df. Returned when output_format is records.",
+                example="['name', 'age']",
+            ),
         ]
 
-    async def _gen_code(self, user_requirement: str, df_schema: dict) -> str:
-        """Generate the code to post-process the DataFrame based on user requirement."""
-        prompt = self.prompt_template.format(
-            user_requirement=user_requirement, df_schema=df_schema
-        )
+    async def _gen_code(self, user_requirement: str, df_schema: str) -> str:
+        """Generate the code to post-process the DataFrame based on user requirement.
+        The code is reused from the cache if the same requirement was seen on the same schema.
+        """
+        cache_key = CodeCache.make_key(user_requirement, df_schema, self.engine)
+        cached_code = await self._code_cache.get(cache_key)
+        if cached_code is not None:
+            self._logger.info(f"Reuse cached code: {cached_code}")
+            return cached_code
+
+        prompt = f"{self._prompt_head}{user_requirement}{self._prompt_mid}{df_schema}{self._prompt_tail}"
         message = Message(content={"input": prompt})
         response_message = await self._llm_tool(message)
         response_text = response_message.get("output", "")
         self._logger.info(f"Generated code: {response_text}")
 
-        match = re.search(r"```python\n(.*)\n```", response_text, re.DOTALL)
+        match = CODE_BLOCK_PATTERN.search(response_text)
         if match:
             code = match.group(1)
         else:
             code = response_text
         self._logger.info(f"Extracted code: {code}")
+        violations = validate_code(code)
+        if violations:
+            self._logger.warning(f"Generated code is not cached: {violations}")
+        else:
+            await self._code_cache.set(cache_key, code)
         return code
 
-    async def _run_code_on_df(self, code: str, df: pd.DataFrame) -> str:
-        """Run the code on the DataFrame."""
-        local_env = {"df": df}  # Local dictionary to store the environment
+    async def _run_code_on_df(self, code: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Run the code on the DataFrame.
+        The original df is returned as is if the code does not pass the validation.
+        """
+        violations = validate_code(code)
+        if violations:
+            self._logger.warning(f"Skip running the invalid code: {violations}")
+            return df
+        if self.engine == "polars":
+            processed_df = self._run_polars_code_on_df(code=code, df=df)
+        else:
+            processed_df = self._run_pandas_code_on_df(code=code, df=df)
+        return processed_df
+
+    def _run_pandas_code_on_df(self, code: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Run the pandas code on the DataFrame.
+        The optimized version of the code is tried first, the original one is the fallback.
+        Each attempt runs on its own copy of df, so neither the caller's df nor the fallback
+        sees the side effects of the code.
+        """
         try:
-            exec(code, {}, local_env)  # Execute the code in the local environment
+            code_obj, optimized_code_obj = compile_code(
+                code, tuple(df.columns), tuple(map(str, df.dtypes))
+            )
+            if optimized_code_obj is not None:
+                local_env = {"df": _copy_for_exec(df)}
+                try:
+                    exec(optimized_code_obj, {}, local_env)
+                    return local_env["processed_df"]
+                except Exception as e:
+                    self._logger.warning(
+                        f"Optimized code failed, run the original: {e}"
+                    )
+            # Local dictionary to store the environment
+            local_env = {"df": _copy_for_exec(df)}
+            exec(code_obj, {}, local_env)  # Execute the code in the local environment
             processed_df = local_env[
                 "processed_df"
             ]  # Assume the processed df is stored in the local environment
@@ -116,36 +423,78 @@ class DataFrameProcessTool(BaseTool):
             self._logger.error(f"Error executing code: {e}")
             raise e  # Or handle it as needed
 
+    def _run_polars_code_on_df(self, code: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Run the polars code on the DataFrame.
+        The query is only collected at the end, so polars can optimize the whole plan.
+        """
+        import polars as pl
+
+        local_env = {"df": pl.from_pandas(df)}
+        try:
+            # The rewrites of compile_code target pandas, so the polars code runs as is.
+            exec(compile(code, "<generated>", "exec"), {}, local_env)
+            processed_df = local_env["processed_df"]
+            if isinstance(processed_df, pl.LazyFrame):
+                processed_df = _collect(
+                    processed_df, streaming=len(df) >= self.streaming_min_rows
+                )
+            return processed_df.to_pandas()
+        except Exception as e:
+            self._logger.error(f"Error executing code: {e}")
+            raise e  # Or handle it as needed
+
     async def _execute(self, input: Message) -> Message:
         """Execute the tool to post-process the DataFrame based on user requirement."""
         user_requirement = input.get("user_requirement", "")
-        df_json = input.get("df_json", "")
-        df = pd.read_json(
-            StringIO(df_json)
-        )  # Figure out the schema from the df json string
-        df_schema = str(df.dtypes.to_dict())
+        df = input.get("df")
+        df_arrow = input.get("df_arrow")
+        in_process = df is not None
+        if not in_process and df_arrow is not None:
+            df = arrow_to_df(df_arrow)
+        elif not in_process:
+            df_json = input.get("df_json", "")
+            df = pd.read_json(
+                StringIO(df_json)
+            )  # Figure out the schema from the df json string
+        df_schema = df_schema_of(df)
         code = await self._gen_code(
             user_requirement=user_requirement, df_schema=df_schema
         )
         processed_df = await self._run_code_on_df(code=code, df=df)
-        processed_df_json = processed_df.to_json()
-        return Message(content={"output": processed_df_json})
+        output_format = input.get("output_format")
+        if output_format is None:
+            output_format = (
+                "df" if in_process else "arrow" if df_arrow is not None else "json"
+            )
+        if output_format == "df":
+            return Message(content={"df": processed_df})
+        if output_format == "records":
+            return Message(
+                content={
+                    "records": processed_df.to_dict("records"),
+                    "columns": processed_df.columns.tolist(),
+                }
+            )
+        if output_format == "arrow":
+            return Message(content={"output_arrow": df_to_arrow(processed_df)})
+        if output_format == "json":
+            processed_df_json = processed_df.to_json()
+            return Message(content={"output": processed_df_json})
+        raise ValueError(f"Unknown output_format: {output_format}")
 
 
 async def main():
     df_process_tool = DataFrameProcessTool()
     filepath = os.path.join(os.path.dirname(__file__), "../example.csv")
-    df = pd.read_csv(filepath)
-    df_json = df.to_json()
+    df = read_csv(filepath)
     filter_by_dau_message = Message(
         content={
             "user_requirement": "Find the top 100 records by GDPU and sort by population desc. Only keep 11.",
-            "df_json": df_json,
+            "df_arrow": df_to_arrow(df),
         }
     )
     output_message = await df_process_tool(filter_by_dau_message)
-    output_df_json = output_message.get("output", "")
-    output_df = pd.read_json(output_df_json)
+    output_df = arrow_to_df(output_message.get("output_arrow"))
     print(output_df.head(100))
     print(f"Number of rows: {len(output_df)}")
 
@@ -0,0 +1,97 @@
+"""Read files with io_uring on Linux, so the large reads are batched in the kernel."""
+
+import os
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import pyarrow as pa
+from polymind.core.logger import Logger
+
+_logger = Logger(__file__)
+
+
+def read_file_with_io_uring(
+    path: str, chunk_size: int = 16 << 20, queue_depth: int = 8
+) -> Optional[pa.Buffer]:
+    """Read the whole file with io_uring, keeping up to queue_depth chunk reads in flight.
+    The chunks are read in place into a single preallocated buffer.
+
+    Args:
+        path (str): The path of the file.
+        chunk_size (int): The size of each read request.
+        queue_depth (int): The number of entries of the ring.
+
+    Returns:
+        Optional[pa.Buffer]: The content of the file, or None if io_uring is not available
+            (not Linux, liburing not installed, or the kernel does not support it)
+            or the read fails, so the caller can fall back to a regular read.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        from liburing import (
+            Cqe,
+            Iovec,
+            Ring,
+            io_uring_cqe_seen,
+            io_uring_get_sqe,
+            io_uring_prep_readv,
+            io_uring_queue_exit,
+            io_uring_queue_init,
+            io_uring_sqe_set_data64,
+            io_uring_submit,
+            io_uring_wait_cqe,
+            trap_error,
+        )
+    except ImportError:
+        return None
+
+    ring = Ring()
+    cqe = Cqe()
+    try:
+        io_uring_queue_init(queue_depth, ring)
+    except OSError as e:
+        _logger.warning(f"io_uring is not available, fall back to buffered read: {e}")
+        return None
+
+    fd = None
+    try:
+        size = os.path.getsize(path)
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        # (start, end) of the file ranges still to read.
+        pending: List[Tuple[int, int]] = [
+            (start, min(start + chunk_size, size))
+            for start in range(0, size, chunk_size)
+        ]
+        # The in flight reads keyed by their start offset. The Iovec must stay alive until
+        # the read completes.
+        inflight: Dict[int, Tuple[int, Iovec]] = {}
+        fd = os.open(path, os.O_RDONLY)
+        while pending or inflight:
+            while pending and len(inflight) < queue_depth:
+                start, end = pending.pop()
+                iovec = Iovec([view[start:end]])
+                sqe = io_uring_get_sqe(ring)
+                io_uring_prep_readv(sqe, fd, iovec, start)
+                io_uring_sqe_set_data64(sqe, start)
+                inflight[start] = (end, iovec)
+            io_uring_submit(ring)
+            io_uring_wait_cqe(ring, cqe)
+            entry = cqe[0]
+            start = entry.user_data
+            read = trap_error(entry.res)
+            io_uring_cqe_seen(ring, entry)
+            end, _ = inflight.pop(start)
+            if read == 0:
+                raise OSError(f"Unexpected end of file while reading {path}.")
+            if start + read < end:
+                pending.append((start + read, end))  # Short read, read the rest.
+    except OSError as e:
+        _logger.warning(f"io_uring read failed, fall back to buffered read: {e}")
+        return None
+    finally:
+        if fd is not None:
+            os.close(fd)
+        io_uring_queue_exit(ring)
+    return pa.py_buffer(buffer)
@@ -6,25 +6,57 @@ import asyncio
 import os
 import threading
 import time
-from io import StringIO
+from concurrent.futures import Future
+from typing import Dict, Tuple
 
 import dash
 import dash_ag_grid as ag
 import dash_html_components as html
 import dash_table
+import numpy as np
 import pandas as pd
 from dash import Input, Output, State, callback, dcc
-from df_tool import DataFrameProcessTool
+from df_tool import DataFrameProcessTool, df_schema_of, read_csv
 from polymind.core.message import Message
 from voice import generate_transcription
 
 # Global flag for recording control
 is_recording = threading.Event()
 latest_message = ""  # Global variable to hold the transcription text
+# The chat history only goes to the tool after it stays unchanged for this many seconds,
+# so a burst of transcription updates triggers a single LLM call. It is measured in time
+# rather than in intervals, as every browser tab has its own interval.
+debounce_seconds = 2.0
+chat_history_updated_at = 0.0  # time.monotonic() of the last chat entry
+
+# The chat history fed to the tool is kept in fixed-size column arrays used as a ring buffer.
+# chat_history_count is the number of entries ever written, the next entry goes to
+# chat_history_count % chat_history_capacity and the oldest ones are overwritten.
+chat_history_capacity = 4096
+chat_history = {
+    "Timestamp": np.empty(chat_history_capacity, dtype=object),
+    "User": np.empty(chat_history_capacity, dtype=object),
+    "Message": np.empty(chat_history_capacity, dtype=object),
+}
+chat_history_count = 0
 
 df: pd.DataFrame = None
 df_process_tool = DataFrameProcessTool()
-chat_history_df = pd.DataFrame(columns=["Timestamp", "User", "Message"])
+
+# A single event loop living in a background thread runs the tool for all the callbacks,
+# so the callbacks do not create and tear down an event loop on every update.
+tool_loop = asyncio.new_event_loop()
+threading.Thread(target=tool_loop.run_forever, daemon=True).start()
+# The tool calls in flight keyed by the requirement and the df schema, so concurrent
+# callbacks (e.g. several browser tabs) wait for the same call instead of calling the LLM again.
+inflight_tool_calls: Dict[Tuple[str, str], Future] = {}
+inflight_lock = threading.Lock()
+chat_history_df = pd.DataFrame(
+    {
+        column: pd.array([], dtype="string[pyarrow]")
+        for column in ["Timestamp", "User", "Message"]
+    }
+)
 
 app = dash.Dash(
     __name__, external_stylesheets=["https://codepen.io/chriddyp/pen/bWLwgP.css"]
@@ -91,6 +123,23 @@ def toggle_voice_input(toggle_values):
         return "Voice recording stopped."
 
 
+def append_chat_history(entry: dict) -> None:
+    """Write the chat entry at the head of the chat history ring buffer."""
+    global chat_history_count, chat_history_updated_at
+    head = chat_history_count % chat_history_capacity
+    for column, values in chat_history.items():
+        values[head] = entry[column]
+    chat_history_count += 1
+    chat_history_updated_at = time.monotonic()
+
+
+def latest_chat_messages() -> np.ndarray:
+    """Get the messages in the chat history ring buffer, from latest to oldest."""
+    count = min(chat_history_count, chat_history_capacity)
+    indices = (chat_history_count - 1 - np.arange(count)) % chat_history_capacity
+    return chat_history["Message"][indices]
+
+
 @callback(
     Output("chat-history-table", "data"),
     Input("interval-component", "n_intervals"),
@@ -109,38 +158,71 @@ def update_chat_history(n_interval, chat_history_data):
             "User": "User",
             "Message": new_message,
         }
+        append_chat_history(new_entry)
         chat_history_data.append(new_entry)
         return chat_history_data
     else:
         return dash.no_update
 
 
+def run_tool(input_message: Message, key: Tuple[str, str]) -> Message:
+    """Run the tool on the shared event loop, joining the call in flight with the same key."""
+    with inflight_lock:
+        future = inflight_tool_calls.get(key)
+        owner = future is None
+        if owner:
+            future = asyncio.run_coroutine_threadsafe(
+                df_process_tool(input_message), tool_loop
+            )
+            inflight_tool_calls[key] = future
+    try:
+        return future.result()
+    finally:
+        if owner:
+            with inflight_lock:
+                inflight_tool_calls.pop(key, None)
+
+
 @callback(
     Output("my-grid", "rowData"),
     Output("my-grid", "columnDefs"),
     Output("requirement-input", "value"),
-    Input("chat-history-table", "data"),
+    Output("processed-chat-count", "data"),
+    Input("interval-component", "n_intervals"),
+    State("processed-chat-count", "data"),
 )
-def update_ag_grid_table(chat_history_data):
-    """Get the chat history from latest to oldest and update the AgGrid table."""
-    chat_history = chat_history_data[
-        ::-1
-    ]  # Reverse the chat history to show latest first
-    # Construct histroy message that can be easily understand by LLM.
-    chat_history_text = "\n".join([entry["Message"] for entry in chat_history])
+def update_ag_grid_table(n_intervals, processed_chat_count):
+    """Get the chat history from latest to oldest and update the AgGrid table.
+    The table is only updated once the chat history is stable for debounce_seconds.
+    Each browser tab keeps the number of chat entries it already processed in its own store,
+    so every tab gets updated, and the tabs updating together share the same tool call.
+    """
+    chat_count = chat_history_count
+    if (
+        chat_count == processed_chat_count
+        or time.monotonic() - chat_history_updated_at < debounce_seconds
+    ):
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+    # Construct histroy message that can be easily understand by LLM, latest first.
+    chat_history_text = "\n".join(latest_chat_messages())
     input_message = Message(
-        content={"user_requirement": chat_history_text, "df_json": df.to_json()}
+        content={
+            "user_requirement": chat_history_text,
+            "df": df,
+            "output_format": "records",
+        }
+    )
+    output_message = run_tool(
+        input_message, key=(chat_history_text, df_schema_of(df))
     )
-    output_message = asyncio.run(df_process_tool(input_message))
-    output_df_json = output_message.get("output", "")
-    output_df = pd.read_json(StringIO(output_df_json))
+    output_df_records = output_message.get("records")
 
-    print(f"Number of rows: {len(output_df)}")
+    print(f"Number of rows: {len(output_df_records)}")
     output_df_column_defs = [
-        {"field": col, "headerName": col} for col in output_df.columns.tolist()
+        {"field": col, "headerName": col} for col in output_message.get("columns")
     ]
-    output_df_records = output_df.to_dict("records")
-    return output_df_records, output_df_column_defs, ""
+    return output_df_records, output_df_column_defs, "", chat_count
 
 
 def create_chat_history_table():
@@ -264,7 +346,8 @@ def generate_app_layout(table_div: html.Div) -> html.Div:
                 children=[
                     dcc.Interval(
                         id="interval-component", interval=1000, n_intervals=0
-                    )  # 1-second interval
+                    ),  # 1-second interval
+                    dcc.Store(id="processed-chat-count", data=0),
                 ],
             ),
             html.Div(id="status-output", style={"whiteSpace": "pre-line"}),
@@ -289,7 +372,7 @@ def generate_interactive_table(table_div: html.Div):
 async def main():
     global df
     csv_path = os.path.join(os.path.dirname(__file__), "../example.csv")
-    df = pd.read_csv(csv_path)
+    df = read_csv(csv_path)
     table_div = create_ag_grid_table(df)
     generate_interactive_table(table_div)
 
@@ -0,0 +1,185 @@
+import ast
+import os
+import sys
+import unittest
+from unittest import mock
+
+import pandas as pd
+from pandas.core.computation.check import NUMEXPR_INSTALLED
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "data_talker"))
+
+import code_rewriter  # noqa: E402
+from code_rewriter import (  # noqa: E402
+    EvalRewriter,
+    numexpr_columns,
+    optimize_code,
+    validate_code,
+)
+
+
+def run(code, df: pd.DataFrame) -> pd.DataFrame:
+    """Run the code, or its compiled syntax tree, on a copy of df and return processed_df."""
+    if isinstance(code, ast.Module):
+        code = compile(code, "<gen>", "exec")
+    local_env = {"df": df.copy()}
+    exec(code, {}, local_env)
+    return local_env["processed_df"]
+
+
+class TestValidateCode(unittest.TestCase):
+    def assert_rejected(self, code: str) -> None:
+        self.assertNotEqual(validate_code(code), (), f"Expected {code} to be rejected.")
+
+    def test_valid_code(self):
+        for code in [
+            "import pandas as pd\nprocessed_df = df.sort_values(by='name', ascending=True)",
+            "import polars as pl\nprocessed_df = df.lazy().sort(by='name', descending=False)",
+            "import numpy as np\nprocessed_df = df[df['gdp'].apply(lambda x: np.log(x) > 1)]",
+            "cols = [c for c in df.columns if len(c) > 2]\nprocessed_df = df[cols]",
+            "from datetime import timedelta\nprocessed_df = df.groupby('name')[['gdp']].sum()",
+            "import pandas as pd\nprocessed_df = df.assign(n=pd.to_numeric(df['count']))",
+        ]:
+            self.assertEqual(validate_code(code), (), code)
+
+    def test_processed_df_is_required(self):
+        self.assert_rejected("result = df.head(2)")
+        self.assert_rejected("processed_df = df.head(")
+
+    def test_module_internals_are_rejected(self):
+        self.assert_rejected(
+            "import pandas as pd\npd.io.common.os.system('id')\nprocessed_df = df"
+        )
+        self.assert_rejected("import os\nprocessed_df = df")
+        self.assert_rejected("import pandas.io.common\nprocessed_df = df")
+        self.assert_rejected("processed_df = df.__class__")
+
+    def test_imported_names_are_checked(self):
+        self.assert_rejected(
+            "from pandas.io.pickle import read_pickle as rp\nprocessed_df = rp('x')"
+        )
+        self.assert_rejected("from pandas import read_pickle\nprocessed_df = df")
+        self.assert_rejected("from pandas import *\nprocessed_df = df")
+
+    def test_file_access_is_rejected(self):
+        self.assert_rejected(
+            "import numpy as np\nprocessed_df = np.load('x.npy', allow_pickle=True)"
+        )
+        for method in ["to_json", "to_html", "to_markdown", "to_latex", "to_xml"]:
+            self.assert_rejected(f"df.{method}('/tmp/out')\nprocessed_df = df")
+
+    def test_unknown_and_forbidden_names_are_rejected(self):
+        self.assert_rejected("processed_df = getattr(df, 'head')(2)")
+        self.assert_rejected("processed_df = os.system")
+        # Binding a forbidden builtin later does not make it usable.
+        self.assert_rejected("x = open('/etc/passwd')\nopen = 1\nprocessed_df = df")
+
+
+class TestOptimizeCode(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame(
+            {
+                "name": ["a", "b", "c", "d"],
+                "count": [3, 1, 4, 1],
+                "gdp": [10.0, 20.0, 30.0, 40.0],
+                "population": [1, 2, 3, 4],
+            }
+        )
+        self.columns = tuple(self.df.columns)
+
+    def assert_same_result(self, code: str) -> ast.Module:
+        tree = optimize_code(code, self.columns)
+        self.assertIsNotNone(tree, f"Expected {code} to be rewritten.")
+        pd.testing.assert_frame_equal(run(tree, self.df), run(code, self.df))
+        return tree
+
+    def test_sort_head_to_nlargest(self):
+        tree = self.assert_same_result(
+            "processed_df = df.sort_values(by='gdp', ascending=False).head(2)"
+        )
+        self.assertIn("nlargest(2, 'gdp')", ast.unparse(tree))
+
+    def test_sort_with_other_options_is_kept(self):
+        code = "processed_df = df.sort_values(by='gdp', na_position='first').head(2)"
+        self.assertIsNone(optimize_code(code, self.columns))
+
+    def test_projection_before_row_filter(self):
+        tree = self.assert_same_result(
+            "processed_df = df[df['gdp'] > 15][['name', 'gdp']]"
+        )
+        self.assertEqual(ast.unparse(tree.body[0]), "df = df[['name', 'gdp']]")
+
+    def test_no_projection_without_row_filter(self):
+        self.assertIsNone(optimize_code("processed_df = df[['name']]", self.columns))
+
+    def test_column_named_like_a_method_is_not_projected(self):
+        code = "processed_df = df[df.count > 1][['name']]"
+        self.assertIsNone(optimize_code(code, self.columns))
+        code = "processed_df = df.count().to_frame()"
+        self.assertIsNone(optimize_code(code, self.columns))
+
+    def test_method_call_keeps_all_columns(self):
+        code = "processed_df = df[df['gdp'] > 15]"
+        self.assertIsNone(optimize_code(code, self.columns))
+
+
+class TestEvalRewriter(unittest.TestCase):
+    columns = ("gdp", "population", "big area")
+
+    def rewrite(self, code: str) -> str:
+        return ast.unparse(EvalRewriter(self.columns).visit(ast.parse(code)))
+
+    def test_column_expression(self):
+        self.assertEqual(
+            self.rewrite("x = df['gdp'] / df.population > 5"),
+            "x = df.eval('((gdp / population) > 5)', engine='numexpr')",
+        )
+
+    def test_quoted_column(self):
+        self.assertIn("`big area`", self.rewrite("x = df['big area'] * 2 + 1"))
+
+    def test_single_operator_is_kept(self):
+        self.assertEqual(self.rewrite("x = df.gdp / 2"), "x = df.gdp / 2")
+
+    def test_constants_only_are_kept(self):
+        self.assertEqual(self.rewrite("n = 60 * 60 * 24"), "n = 60 * 60 * 24")
+        self.assertEqual(
+            self.rewrite("x = df.head(2 * 2 + 1)"), "x = df.head(2 * 2 + 1)"
+        )
+
+    def test_power_is_kept(self):
+        self.assertEqual(
+            self.rewrite("x = df.gdp ** df.population + 1"),
+            "x = df.gdp ** df.population + 1",
+        )
+
+    def test_not_applied_without_numexpr(self):
+        code = "processed_df = df[df['gdp'] / df['population'] > 5]"
+        dtypes = ("float64", "int64", "float64")
+        with mock.patch.object(code_rewriter, "NUMEXPR_INSTALLED", False):
+            self.assertIsNone(optimize_code(code, self.columns, dtypes))
+
+    def test_not_applied_on_extension_dtypes(self):
+        code = "processed_df = df[df['gdp'] / df['population'] > 5]"
+        dtypes = ("double[pyarrow]", "int64[pyarrow]", "string")
+        with mock.patch.object(code_rewriter, "NUMEXPR_INSTALLED", True):
+            self.assertIsNone(optimize_code(code, self.columns, dtypes))
+            self.assertIsNone(optimize_code(code, self.columns))
+
+    def test_numexpr_columns(self):
+        self.assertEqual(
+            numexpr_columns(self.columns, ("float64", "Int64", "bool")),
+            ("gdp", "big area"),
+        )
+
+    @unittest.skipUnless(NUMEXPR_INSTALLED, "numexpr is not installed")
+    def test_same_result_with_numexpr(self):
+        df = pd.DataFrame({"gdp": [10.0, 20.0, 30.0], "population": [1, 5, 2]})
+        code = "processed_df = df[df['gdp'] / df['population'] > 5]"
+        tree = optimize_code(code, tuple(df.columns), tuple(map(str, df.dtypes)))
+        self.assertIsNotNone(tree)
+        pd.testing.assert_frame_equal(run(tree, df), run(code, df))
+
+
+if __name__ == "__main__":
+    unittest.main()